@@ -3,6 +3,7 @@ __all__ = [
     "RowerDatapackage",
     "DATAPATH",
     "DEFAULT_EXCLUSIONS",
+    "IncrementalRower",
     "USERPATH"
 ]
 
@@ -19,3 +20,4 @@ if not os.path.isdir(USERPATH):
 
 from .data_package import RowerDatapackage
 from .base import Rower, DEFAULT_EXCLUSIONS
+from .incremental import IncrementalRower
@@ -1,11 +1,33 @@
 from . import DATAPATH, USERPATH, RowerDatapackage
-from bw2data.backends.peewee import ActivityDataset as AD
-from bw2data import databases
-from collections import defaultdict
+from .data_package import is_archive
+from .geography import canonicalize, merge_similar
+from .profiling import MemoryProfiler
+from .matrices import (
+    USER_ID_OFFSET,
+    assign_geography_ids,
+    exclusion_matrix,
+    geography_id_array,
+    geography_index,
+    save_exclusion_matrix,
+)
+from bw2data.backends.peewee import ActivityDataset as AD, sqlite3_lci_db
+from bw2data import databases, geomapping
+from bw2data.search import IndexManager
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from itertools import count
+from peewee import fn
 import bw2data
+import json
 import os
 import pyprind
+import tempfile
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 DEFAULT_EXCLUSIONS = [
@@ -17,6 +39,38 @@ DEFAULT_EXCLUSIONS = [
 ]
 
 
+def _shard(name, product, partitions):
+    """Return the partition number of a ``(name, product)`` key. Stable across processes."""
+    key = "{}\x00{}".format(name, product).encode("utf-8")
+    return zlib.crc32(key) % partitions
+
+
+@contextmanager
+def _no_profiling():
+    yield {}
+
+
+@contextmanager
+def _locked(filepath):
+    """Hold an exclusive lock on ``filepath``, which is created if needed. No lock is taken where ``fcntl`` isn't available (Windows)."""
+    with open(filepath, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _write_json(filepath, data):
+    """Write ``data`` to ``filepath`` through a temporary file, so readers never see a partly written file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix=".tmp")
+    try:
+        with open(fd, "w", encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, filepath)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 class Rower(object):
     EI_GENERIC = os.path.join(DATAPATH, "ecoinvent generic")
     EI_3_3_APOS = os.path.join(DATAPATH, "ecoinvent 3.3 apos")
@@ -29,7 +83,7 @@ class Rower(object):
     EI_3_5_CUTOFF = os.path.join(DATAPATH, "ecoinvent 3.5 cutoff")
     EI_3_5_CONSEQUENTIAL = os.path.join(DATAPATH, "ecoinvent 3.5 consequential")
 
-    def __init__(self, database):
+    def __init__(self, database, profile_memory=False):
         """Initiate ``Rower`` object to consistently label 'Rest-of-World' locations in LCI databases.
 
         ``database`` must be a registered database.
@@ -39,6 +93,7 @@ class Rower(object):
         * Define RoWs in a given database (``define_RoWs``). This will use the RoW labels in the master data, or create new user RoWs.
         * Load saved RoW definitions (``read_datapackage``).
         * Relabel activity locations in a given database using the generated RoW labels (``label_RoWs``).
+        * Undo relabelling using the recorded journal (``rollback``), or restore the generic ``RoW`` label (``unlabel_RoWs``).
         * Save user RoW definitions for reuse in a standard format (``write_datapackage``).
         * Import a ``geocollection`` and ``topocollection`` into bw2regional (bw2regional must be installed) (Not implemented).
 
@@ -48,8 +103,12 @@ class Rower(object):
         * ``self.existing``: ``{"RoW label": ["list of excluded locations"]}``
         * ``self.user_rows``: ``{"RoW label": ["list of excluded locations"]}``
         * ``self.labelled``: ``{"RoW label": ["list of activity codes"]}``
+        * ``self.geography_ids``: ``{"RoW label or location": integer id}``
+        * ``self.journal``: ``[("activity code", "old location", "new location")]``, recorded by ``label_RoWs`` and ``unlabel_RoWs``
+
+        If ``profile_memory``, the memory used by each phase (loading, grouping, relabelling) is recorded in ``self.memory_profiler``; see ``rower.profiling.MemoryProfiler.report``. Tracing stays on until ``self.memory_profiler.stop()`` is called, and slows down ``Rower`` considerably.
 
-        ``self.existing`` should be loaded (using ``self.load_existing``) from a previous saved result, while ``self.user_rows`` are new RoWs not found in ``self.existing``. When saving to a data package, only ``self.user_rows`` and ``self.labelled`` are saved.
+        ``self.existing`` should be loaded (using ``self.load_existing``) from a previous saved result, while ``self.user_rows`` are new RoWs not found in ``self.existing``. When saving to a data package, only ``self.user_rows``, ``self.labelled``, and ``self.geography_ids`` are saved.
 
         """
         assert database in bw2data.databases, "Database {} not registered".format(database)
@@ -57,16 +116,21 @@ class Rower(object):
         self.existing = {}
         self.user_rows = {}
         self.labelled = {}
+        self.geography_ids = {}
+        self.journal = []
+        self.memory_profiler = MemoryProfiler() if profile_memory else None
 
     def list_existing(self):
-        """List existing RoW definition data packages"""
+        """List existing RoW definition data packages (directories or archives)"""
         return [os.path.join(DATAPATH, o) for o in os.listdir(DATAPATH)
-                if os.path.isdir(os.path.join(DATAPATH,o))] + \
+                if os.path.isdir(os.path.join(DATAPATH,o))
+                or is_archive(os.path.join(DATAPATH, o))] + \
                [os.path.join(USERPATH, o) for o in os.listdir(USERPATH)
-                if os.path.isdir(os.path.join(USERPATH,o))]
+                if os.path.isdir(os.path.join(USERPATH,o))
+                or is_archive(os.path.join(USERPATH, o))]
 
     def load_existing(self, dirname):
-        """Load a data package and populate ``self.existing`` and/or ``self.labelled``.
+        """Load a data package and populate ``self.existing``, ``self.labelled``, and/or ``self.geography_ids``.
 
         Returns *all* the data package resources."""
         data = RowerDatapackage(dirname).read_data()
@@ -74,6 +138,8 @@ class Rower(object):
             self.labelled = data["Activity mapping"]
         if "Rest-of-World definitions" in data:
             self.existing = data["Rest-of-World definitions"]
+        if "Geography ids" in data:
+            self.geography_ids = data["Geography ids"]
         return data
 
     def apply_existing_activity_map(self, dirname):
@@ -86,6 +152,44 @@ class Rower(object):
             raise ValueError("No activity mapping found")
         self.labelled = dct['Activity mapping']
 
+    def validate_activity_map(self, dirname=None):
+        """Check that an activity mapping matches the database, without changing anything.
+
+        Uses the activity mapping in data package ``dirname`` (a path, or the name of a package in the builtin or user data directories) if given, otherwise ``self.labelled``. Raises ``OSError`` if the package can't be found.
+
+        Returns a dictionary with the following keys:
+
+        * ``mapped``: Number of activity codes in the mapping
+        * ``duplicates``: Codes mapped to more than one RoW label
+        * ``missing``: Mapped codes not found in the database
+        * ``not_row``: Mapped codes whose location is neither ``RoW`` nor the mapped label
+        * ``unmapped``: Codes of ``RoW`` activities in the database which aren't mapped
+        * ``valid``: ``True`` if all of the above lists are empty
+
+        """
+        if dirname is None:
+            labelled = self.labelled
+        else:
+            labelled = self._get_saved(dirname).get("Activity mapping", {})
+        pairs = [(code, label) for label, codes in labelled.items() for code in codes]
+        counts = Counter(code for code, _ in pairs)
+
+        if self.db.backend == 'sqlite':
+            missing, not_row, unmapped = self._validate_sqlite(pairs)
+        else:
+            missing, not_row, unmapped = self._validate_other_backend(pairs)
+
+        report = {
+            "mapped": len(counts),
+            "duplicates": sorted(code for code, n in counts.items() if n > 1),
+            "missing": sorted(missing),
+            "not_row": sorted(not_row),
+            "unmapped": sorted(unmapped),
+        }
+        report["valid"] = not any(report[key] for key in
+                                  ("duplicates", "missing", "not_row", "unmapped"))
+        return report
+
     def save_data_package(self, dirname, name, overwrite=False):
         """Save definitions and activity mapping to a data package. Returns path of created directory.
 
@@ -96,10 +200,86 @@ class Rower(object):
         if os.path.exists(dirpath) and not overwrite:
             raise OSError("Directory already exists")
         dp = RowerDatapackage(dirpath)
-        dp.write_data(name, self.user_rows, self.labelled)
+        dp.write_data(name, self.user_rows, self.labelled, self.geography_ids)
         return dirpath
 
-    def define_RoWs(self, prefix="RoW_user", default_exclusions=True):
+    def exclusion_matrix(self):
+        """Return a sparse matrix of the locations excluded by each activity in ``self.labelled``.
+
+        RoW definitions are taken from ``self.existing`` and ``self.user_rows``. Returns ``(matrix, codes, locations)``; see ``rower.matrices.exclusion_matrix``."""
+        definitions = dict(self.existing)
+        definitions.update(self.user_rows)
+        return exclusion_matrix(self.labelled, definitions)
+
+    def save_exclusion_matrix(self, filepath):
+        """Save the result of ``self.exclusion_matrix`` to a ``.npz`` file. Returns ``filepath``.
+
+        Load it again with ``rower.matrices.load_exclusion_matrix``."""
+        save_exclusion_matrix(filepath, *self.exclusion_matrix())
+        return filepath
+
+    def assign_geography_ids(self):
+        """Give a stable integer id to every RoW label and location used in this database.
+
+        Ids come from a registry shared by all databases and data packages of this user (``geography_ids.json`` in ``USERPATH``). The ids of the ``ecoinvent generic`` data package are merged into the registry every time, so labels added by new ``rower`` releases are picked up; they always keep their shipped ids. Shipped ids are below ``rower.matrices.USER_ID_OFFSET``, and new labels and locations get ids at or above it, so the two never collide. Other ids are never changed, so the same label has the same id in every data package created with this registry. Ids in data packages from other users may differ for labels not in ``ecoinvent generic``.
+
+        Ids already in ``self.geography_ids`` (e.g. loaded from a data package) are added to the registry; raises ``ValueError`` if they conflict with it.
+
+        The registry is locked while it is updated, so concurrent jobs on the same machine get consistent ids.
+
+        Updates and returns ``self.geography_ids``."""
+        labels = set(self.existing).union(self.user_rows, self.labelled)
+        labels.update(location for _, location in self._load_locations())
+        self.geography_ids = self._update_id_registry(labels)
+        return self.geography_ids
+
+    def _update_id_registry(self, labels):
+        """Add the shipped ids, ``self.geography_ids``, and ids for ``labels`` to the id registry, and return it"""
+        registry_path = os.path.join(USERPATH, "geography_ids.json")
+        shipped = RowerDatapackage(self.EI_GENERIC).read_data()["Geography ids"]
+        with _locked(registry_path + ".lock"):
+            if os.path.isfile(registry_path):
+                with open(registry_path, encoding='utf-8') as f:
+                    registry = json.load(f)
+            else:
+                registry = {}
+
+            # Registries written before the id ranges were reserved can use
+            # ids which a newer release gives to a shipped label
+            shipped_ids = set(shipped.values())
+            moved = [label for label, id_ in registry.items()
+                     if id_ in shipped_ids and shipped.get(label) != id_]
+            for label in moved:
+                del registry[label]
+            registry.update(shipped)
+            registry = assign_geography_ids(registry, moved, start=USER_ID_OFFSET)
+
+            used = {v: k for k, v in registry.items()}
+            for label, id_ in self.geography_ids.items():
+                if registry.get(label, id_) != id_ or used.get(id_, label) != label:
+                    raise ValueError("Geography id {} of {} conflicts with the id registry".format(
+                        id_, label))
+                registry[label] = id_
+                used[id_] = label
+
+            registry = assign_geography_ids(registry, labels, start=USER_ID_OFFSET)
+            _write_json(registry_path, registry)
+        return registry
+
+    def geography_index(self):
+        """Return a lookup index from activity codes to geography ids, using the current database locations and ``self.geography_ids``.
+
+        See ``rower.matrices.geography_index``; reuse the index when calling ``geography_id_array`` many times."""
+        return geography_index(self._load_locations(), self.geography_ids)
+
+    def geography_id_array(self, codes, index=None):
+        """Return an ``int32`` array of the geography ids of the activities in ``codes``.
+
+        Run ``label_RoWs`` and ``assign_geography_ids`` first. Unknown codes and locations get ``-1``."""
+        return geography_id_array(codes, index or self.geography_index())
+
+    def define_RoWs(self, prefix="RoW_user", default_exclusions=True, containment=None,
+                    partitions=None):
         """Generate and return "RoW definition" dict and "activities to new RoW" dict.
 
         "RoW definition" identifies the geographies that are to be **excluded** from the RoW.
@@ -108,20 +288,36 @@ class Rower(object):
         The "activities to new RoW" dict identifies which activities have which each RoW.
         It has the structure {'RoW_0': ['code of activity', 'code of another activity']}
 
+        If ``containment`` is given, excluded locations are expanded into leaf locations before grouping, so that e.g. a RoW excluding ``CA`` and one excluding all Canadian provinces get the same label. ``containment`` has the structure ``{region: [leaf locations]}``, and can be created with ``rower.geography.containment_from_topomapping``. Existing RoW definitions are expanded in the same way before being matched.
+
+        If ``partitions`` is given, the ``(name, product)`` keys are hashed into this number of partitions, which are loaded and grouped one at a time. Only the grouped RoW activity codes are kept between partitions, which limits peak memory use for very large databases.
+
         Resets ``self.user_rows`` and ``self.labelled``.
 
         """
         assert prefix, "A prefix must be specified"
-        if self.db.backend == 'sqlite':
-            data = self._load_groups_sqlite()
-        else:
-            # data now in format {(name, product): [(location, code)]
-            data = self._load_groups_other_backend()
+        assert partitions is None or partitions > 0, "``partitions`` must be a positive integer"
 
         counter = count()
         # Group by list of excluded locations into format:
         # {tuple(sorted([location])): [RoW activity code]}
-        grouped_data = self._reformat_rows(data, default_exclusions=default_exclusions)
+        grouped_data = defaultdict(list)
+        for shard in range(partitions or 1):
+            with self._phase("load groups") as counts:
+                if self.db.backend == 'sqlite':
+                    data = self._load_groups_sqlite(shard, partitions)
+                else:
+                    # data now in format {(name, product): [(location, code)]
+                    data = self._load_groups_other_backend(shard, partitions)
+                counts.update(groups=len(data), activities=sum(len(v) for v in data.values()))
+            with self._phase("group") as counts:
+                for excluded, codes in self._reformat_rows(
+                        data, default_exclusions=default_exclusions,
+                        containment=containment).items():
+                    grouped_data[excluded].extend(codes)
+                del data
+                counts.update(exclusion_sets=len(grouped_data),
+                              codes=sum(len(v) for v in grouped_data.values()))
 
         self.user_rows = {}
         self.labelled = {}
@@ -130,7 +326,12 @@ class Rower(object):
             return self.labelled, self.user_rows
 
         # From row_x: [locations] to (locations): row_x
-        existing_reversed = {tuple(v): k for k, v in self.existing.items()}
+        if containment:
+            existing_reversed = {}
+            for k in sorted(self.existing, reverse=True):
+                existing_reversed[canonicalize(self.existing[k], containment)] = k
+        else:
+            existing_reversed = {tuple(v): k for k, v in self.existing.items()}
 
         # For tuples of excluded locations
         for excluded in sorted(grouped_data):
@@ -149,41 +350,144 @@ class Rower(object):
 
         return self.labelled, self.user_rows
 
+    def merge_RoWs(self, topomapping, areas, tolerance=0.001):
+        """Merge RoWs in ``self.labelled`` whose areas are nearly identical.
+
+        ``topomapping`` is ``{RoW label: [face ids]}`` (see ``rower.geography.load_topomapping``), and ``areas`` is ``{face id: area}``. RoWs whose symmetric difference is at most ``tolerance`` (as a fraction of the larger area) are given the same label; see ``rower.geography.merge_similar``. RoWs not in ``topomapping`` are left unchanged.
+
+        Updates ``self.labelled`` and ``self.user_rows``. Returns ``{merged label: (new label, error as area fraction)}``."""
+        mapping, errors = merge_similar(
+            {k: v for k, v in topomapping.items() if k in self.labelled},
+            areas,
+            tolerance
+        )
+        report = {}
+        for label, representative in sorted(mapping.items()):
+            if label == representative:
+                continue
+            self.labelled[representative].extend(self.labelled.pop(label))
+            self.user_rows.pop(label, None)
+            report[label] = (representative, errors[label])
+        return report
+
     def label_RoWs(self):
         """Update the ``location`` labels in the given database with the generated RoWs stored in ``self.labelled``.
 
+        Changes are added to ``self.journal``, and can be undone with ``rollback``.
+
         Returns the number of locations changed."""
         assert hasattr(self, "labelled") and hasattr(self, "user_rows"), "Must run ``define_RoWs`` first"
-        mapping = {code: row for row, lst in self.labelled.items() for code in lst}
+        with self._phase("label") as counts:
+            mapping = {code: row for row, lst in self.labelled.items() for code in lst}
+            changes = self._relabel(mapping)
+            counts.update(labels=len(self.labelled), codes=len(mapping), changed=len(changes))
+        if self.db.backend != 'sqlite':
+            self.db.metadata['rowed'] = True
+            databases.flush()
+        self.journal.extend(changes)
+        return len(changes)
 
+    def unlabel_RoWs(self, dirname=None):
+        """Set the ``location`` of RoW activities back to the generic ``RoW`` label.
+
+        Uses the activity codes in the activity mapping of data package ``dirname`` (a path, or the name of a package in the builtin or user data directories) if given, otherwise all activities in ``self.journal``. Raises ``OSError`` if the package can't be found. Changes are added to ``self.journal``.
+
+        Returns the number of locations changed."""
+        if dirname is None:
+            codes = {code for code, _, _ in self.journal}
+        else:
+            labelled = self._get_saved(dirname).get("Activity mapping", {})
+            codes = {code for lst in labelled.values() for code in lst}
+        changes = self._relabel(dict.fromkeys(codes, "RoW"))
+        if self.db.backend != 'sqlite':
+            self.db.metadata['rowed'] = False
+            databases.flush()
+        self.journal.extend(changes)
+        return len(changes)
+
+    def rollback(self):
+        """Undo all the location changes in ``self.journal``, and empty the journal.
+
+        Returns the number of locations changed."""
+        mapping = {}
+        for code, old, _ in reversed(self.journal):
+            mapping[code] = old
+        changes = self._relabel(mapping)
+        self.journal = []
+        return len(changes)
+
+    def save_journal(self, filepath):
+        """Save ``self.journal`` to a JSON file. Returns ``filepath``."""
+        with open(filepath, "w", encoding='utf-8') as f:
+            json.dump(self.journal, f, ensure_ascii=False)
+        return filepath
+
+    def load_journal(self, filepath):
+        """Load ``self.journal`` from a JSON file created by ``save_journal``."""
+        with open(filepath, encoding='utf-8') as f:
+            self.journal = [tuple(x) for x in json.load(f)]
+        return self.journal
+
+    def _phase(self, name):
+        """Memory profiling context manager for phase ``name``; does nothing unless ``profile_memory``"""
+        if self.memory_profiler is None:
+            return _no_profiling()
+        return self.memory_profiler.phase(name)
+
+    def _relabel(self, mapping):
+        """Set the location of each activity code in ``mapping``.
+
+        Returns list of ``(code, old location, new location)`` for the locations that changed."""
+        if not mapping:
+            return []
         if self.db.backend == 'sqlite':
             return self._update_locations_sqlite(mapping)
         else:
             return self._update_locations_other(mapping)
 
-    def _load_groups_other_backend(self):
-        """Return dictionary of ``{(name, product): [(location, code)]`` from non-SQLite3 database"""
+    def _load_locations(self):
+        """Return list of ``(code, location)`` for all activities in the database"""
+        if self.db.backend == 'sqlite':
+            return list(AD.select(AD.code, AD.location).where(
+                AD.database == self.db.name).tuples())
+        return [(obj['code'], obj.get('location')) for obj in self.db]
+
+    def _load_groups_other_backend(self, shard=None, partitions=None):
+        """Return dictionary of ``{(name, product): [(location, code)]`` from non-SQLite3 database.
+
+        Only returns keys in partition ``shard`` if ``partitions`` is given."""
         data = defaultdict(list)
-        for obj in bw2data.Database(database):
-            data[(obj['name'], obj['product'])].append((obj['location'], obj['code']))
+        for obj in self.db:
+            key = (obj['name'], obj.get('reference product'))
+            if partitions and _shard(key[0], key[1], partitions) != shard:
+                continue
+            data[key].append((obj['location'], obj['code']))
         return data
 
-    def _load_groups_sqlite(self):
-        """Return dictionary of ``{(name, product): [(location, code)]`` from SQLite3 database"""
+    def _load_groups_sqlite(self, shard=None, partitions=None):
+        """Return dictionary of ``{(name, product): [(location, code)]`` from SQLite3 database.
+
+        Only returns keys in partition ``shard`` if ``partitions`` is given."""
         data = defaultdict(list)
         # AD is the ActivityDataset db table (Model in Peewee) imported from bw2data.backends.peewee
+        where = [AD.database == self.db.name]
+        if partitions:
+            AD._meta.database.register_function(_shard, "rower_shard", 3)
+            where.append(fn.rower_shard(AD.name, AD.product, partitions) == shard)
         qs = list(AD.select(AD.name, AD.product, AD.location, AD.code).where(
-            AD.database == self.db.name).dicts())
+            *where).dicts())
         for obj in qs:
             data[(obj['name'], obj['product'])].append((obj['location'], obj['code']))
         return data
 
-    def _reformat_rows(self, data, default_exclusions=True):
+    def _reformat_rows(self, data, default_exclusions=True, containment=None):
         """Transform ``data`` from ``{(name, product): [(location, code)]}`` to ``{tuple(sorted([location])): [RoW activity code]}``.
 
         ``RoW`` must be one of the locations (and is deleted).
 
-        Adds default exclusions if ``default_exclusions``."""
+        Adds default exclusions if ``default_exclusions``.
+
+        Expands locations to leaf locations if ``containment`` is given (see ``rower.geography.canonicalize``)."""
         result = defaultdict(list)
 
         if default_exclusions is True:
@@ -196,47 +500,119 @@ class Rower(object):
         for lst in data.values():
             if 'RoW' not in [x[0] for x in lst]:
                 continue
-            result[tuple(sorted([x[0] for x in lst if x[0] != "RoW"] +
-                                exclusions))
-                 ].extend([x[1] for x in lst if x[0] == 'RoW'])
+            excluded = [x[0] for x in lst if x[0] != "RoW"] + exclusions
+            if containment:
+                excluded = canonicalize(excluded, containment)
+            else:
+                excluded = tuple(sorted(excluded))
+            result[excluded].extend([x[1] for x in lst if x[0] == 'RoW'])
         return result
 
-    def _update_locations_sqlite(self, mapping):
-        count = 0
-
-        searchable = self.db.metadata.get('searchable')
-        if searchable:
-            self.db.make_unsearchable()
+    def _validate_sqlite(self, pairs):
+        """Check ``[(code, label)]`` against the database using a temporary table and joins.
+
+        Returns lists of missing, non-RoW, and unmapped RoW codes."""
+        db = AD._meta.database
+        table = AD._meta.table_name
+        db.execute_sql("CREATE TEMP TABLE rower_mapping (code TEXT, label TEXT)")
+        try:
+            with db.atomic():
+                db.cursor().executemany("INSERT INTO rower_mapping VALUES (?, ?)", pairs)
+            db.execute_sql("CREATE INDEX temp.rower_mapping_code ON rower_mapping (code)")
+            missing = db.execute_sql(
+                'SELECT DISTINCT m.code FROM rower_mapping m LEFT JOIN "{}" a '
+                'ON a.database = ? AND a.code = m.code WHERE a.code IS NULL'.format(table),
+                (self.db.name,)
+            ).fetchall()
+            not_row = db.execute_sql(
+                'SELECT DISTINCT m.code FROM rower_mapping m JOIN "{}" a '
+                'ON a.database = ? AND a.code = m.code '
+                'WHERE a.location IS NULL OR (a.location != \'RoW\' '
+                'AND a.location != m.label)'.format(table),
+                (self.db.name,)
+            ).fetchall()
+            unmapped = db.execute_sql(
+                'SELECT a.code FROM "{}" a LEFT JOIN rower_mapping m ON m.code = a.code '
+                'WHERE a.database = ? AND a.location = \'RoW\' '
+                'AND m.code IS NULL'.format(table),
+                (self.db.name,)
+            ).fetchall()
+        finally:
+            db.execute_sql("DROP TABLE temp.rower_mapping")
+        return [x[0] for x in missing], [x[0] for x in not_row], [x[0] for x in unmapped]
+
+    def _validate_other_backend(self, pairs):
+        """Check ``[(code, label)]`` against a non-SQLite3 database.
+
+        Returns lists of missing, non-RoW, and unmapped RoW codes."""
+        locations = dict(self._load_locations())
+        mapping = dict(pairs)
+        missing = {code for code, _ in pairs if code not in locations}
+        not_row = {code for code, label in pairs if code in locations
+                   and locations[code] not in ("RoW", label)}
+        unmapped = [code for code, location in locations.items()
+                    if location == "RoW" and code not in mapping]
+        return list(missing), list(not_row), unmapped
 
-        for act in pyprind.prog_bar(self.db):
-            try:
-                act['location'] = mapping[act['code']]
-                act.save()
-                count += 1
-            except KeyError:
-                continue
-
-        if searchable:
-            self.db.make_unsearchable()
-
-        return count
+    def _update_locations_sqlite(self, mapping):
+        """Update locations of the activities in ``mapping`` in one transaction, only loading these activities.
+
+        Rows are saved directly instead of with ``Activity.save``, so the search index isn't updated for each activity; changed activities are reindexed in one batch afterwards. Database metadata (e.g. ``searchable``) is not changed during relabelling."""
+        changes = []
+        changed = []
+
+        codes = sorted(mapping)
+        with sqlite3_lci_db.atomic():
+            # Chunks stay below the SQLite limit on query parameters
+            for i in pyprind.prog_bar(range(0, len(codes), 500)):
+                qs = AD.select().where(
+                    AD.database == self.db.name, AD.code.in_(codes[i:i + 500]))
+                for ds in qs:
+                    old, new = ds.data.get('location'), mapping[ds.code]
+                    if old == new:
+                        continue
+                    ds.data['location'] = ds.location = new
+                    ds.save()
+                    changes.append((ds.code, old, new))
+                    changed.append(ds.data)
+
+        if changes:
+            databases.set_dirty(self.db.name)
+            geomapping.add({new for _, _, new in changes})
+        if changed and self.db.metadata.get('searchable', True):
+            self._update_search_index(changed)
+
+        return changes
+
+    def _update_search_index(self, datasets):
+        """Update the search index entries of ``datasets`` with a single index writer.
+
+        The writer is cancelled on errors, so the index isn't left locked."""
+        index = IndexManager(self.db.filename)
+        writer = index.get().writer()
+        try:
+            for ds in datasets:
+                # Same document format as ``Activity.save`` uses
+                writer.update_document(**index._format_dataset(ds))
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit()
 
     def _update_locations_other(self, mapping):
-        count = 0
+        changes = []
         data = self.db.load()
         for k, v in data.items():
-            if k[1] in mapping:
+            if k[1] in mapping and v.get('location') != mapping[k[1]]:
+                changes.append((k[1], v.get('location'), mapping[k[1]]))
                 v['location'] = mapping[k[1]]
-                count += 1
-        if count:
+        if changes:
             self.db.write(data)
-        self.db.metadata['rowed'] = True
-        databases.flush()
-        return count
+        return changes
 
     def _get_saved(self, dirname):
-        if os.path.isdir(os.path.join(DATAPATH, dirname)):
-            return RowerDatapackage(os.path.join(DATAPATH, dirname)).read_data()
-        elif os.path.isdir(os.path.join(USERPATH, dirname)):
-            return RowerDatapackage(os.path.join(USERPATH, dirname)).read_data()
+        for base in (DATAPATH, USERPATH):
+            path = os.path.join(base, dirname)
+            if os.path.isdir(path) or is_archive(path):
+                return RowerDatapackage(path).read_data()
         raise OSError("Can't find specified directory")
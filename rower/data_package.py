@@ -1,28 +1,50 @@
+from collections.abc import Mapping
 import bw2data
 import datetime
+import hashlib
 import json
 import os
+import sys
+import zipfile
+
+
+def is_archive(path):
+    """Return ``True`` if ``path`` is a single-file (zip) data package archive"""
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
 
 
 class RowerDatapackage(object):
     def __init__(self, dirpath):
-        if not os.path.exists(dirpath):
-            os.mkdir(dirpath)
-        elif not os.path.isdir(dirpath) or not os.access(dirpath, os.W_OK):
-            raise ValueError("``dirpath`` must be a writable directory")
+        """Data package in directory ``dirpath``, or in the zip archive ``dirpath`` (created with ``write_archive``).
+
+        ``dirpath`` is only created when data is written. Archives, and directories without write access, can only be read."""
+        if os.path.exists(dirpath) and not os.path.isdir(dirpath) and not is_archive(dirpath):
+            raise ValueError("``dirpath`` must be a directory or a data package archive")
         self.path = dirpath
-        if "datapackage.json" in os.listdir(self.path):
+        self.archive = is_archive(dirpath)
+        if self.archive:
+            with zipfile.ZipFile(self.path) as zf:
+                self.metadata = json.loads(zf.read("datapackage.json").decode("utf-8"))
+        elif os.path.isdir(self.path) and "datapackage.json" in os.listdir(self.path):
             self.metadata = self._read_json(os.path.join(self.path, "datapackage.json"))
         else:
             self.metadata = None
 
     @property
     def empty(self):
+        if self.archive:
+            return False
+        if not os.path.isdir(self.path):
+            return True
         return not any(x.endswith(".json") for x in os.listdir(self.path))
 
-    def write_data(self, name, definitions=None, activity_mapping=None):
+    def write_data(self, name, definitions=None, activity_mapping=None, geography_ids=None):
         assert definitions or activity_mapping, \
             "Must provide either ``definitions`` or ``activity_mapping``"
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        elif self.archive or not os.access(self.path, os.W_OK):
+            raise ValueError("``dirpath`` must be a writable directory")
         if not self.empty:
             for root, dirs, files in os.walk(self.path):
                 for filename in files:
@@ -31,9 +53,18 @@ class RowerDatapackage(object):
             self._save_json(definitions, "definitions.json")
         if activity_mapping:
             self._save_json(activity_mapping, "activity_mapping.json")
+        if geography_ids:
+            self._save_json(geography_ids, "geography_ids.json")
         self._write_datapackage(name)
 
     def read_data(self):
+        """Return ``{resource name: data}`` for all JSON resources.
+
+        For archives, returns a read-only mapping which only decompresses (and checks) each resource when it is first accessed. Raises ``OSError`` if there is no data package at ``dirpath``."""
+        if self.metadata is None:
+            raise OSError("Can't find data package {}".format(self.path))
+        if self.archive:
+            return _ArchiveResources(self.path, self.metadata["resources"])
         data = {}
         for resource in self.metadata["resources"]:
             assert (bw2data.filesystem.md5(
@@ -46,6 +77,21 @@ class RowerDatapackage(object):
             )
         return data
 
+    def write_archive(self, filepath):
+        """Write this data package to a single zip archive ``filepath``, which can be read with ``RowerDatapackage(filepath)``. Returns ``filepath``.
+
+        Resources are compressed with the fastest DEFLATE level (the default level before Python 3.7); ``datapackage.json`` is stored uncompressed."""
+        assert self.metadata, "Empty data package"
+        # ``compresslevel`` was added in Python 3.7
+        options = {"compresslevel": 1} if sys.version_info >= (3, 7) else {}
+        with zipfile.ZipFile(filepath, "w") as zf:
+            zf.write(os.path.join(self.path, "datapackage.json"), "datapackage.json",
+                     compress_type=zipfile.ZIP_STORED)
+            for resource in self.metadata["resources"]:
+                zf.write(os.path.join(self.path, resource["path"]), resource["path"],
+                         compress_type=zipfile.ZIP_DEFLATED, **options)
+        return filepath
+
     def _save_json(self, data, filename):
         with open(os.path.join(self.path, filename), "w", encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
@@ -99,3 +145,37 @@ class RowerDatapackage(object):
                     os.path.join(self.path, "activity_mapping.json")
                 )
             })
+        if "geography_ids.json" in os.listdir(self.path):
+            self.metadata["resources"].append({
+                "name": "Geography ids",
+                "path": "geography_ids.json",
+                "description": "Mapping from RoW label or location to stable integer id",
+                "format": "json",
+                "hash": bw2data.filesystem.md5(
+                    os.path.join(self.path, "geography_ids.json")
+                )
+            })
+
+
+class _ArchiveResources(Mapping):
+    """Read-only mapping of resource name to data, decompressed from the archive on first access"""
+    def __init__(self, path, resources):
+        self.path = path
+        self.resources = {r["name"]: r for r in resources if r["format"] == "json"}
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            resource = self.resources[name]
+            with zipfile.ZipFile(self.path) as zf:
+                content = zf.read(resource["path"])
+            assert hashlib.md5(content).hexdigest() == resource["hash"], \
+                "Data integrity failure"
+            self._cache[name] = json.loads(content.decode("utf-8"))
+        return self._cache[name]
+
+    def __iter__(self):
+        return iter(self.resources)
+
+    def __len__(self):
+        return len(self.resources)
@@ -0,0 +1,83 @@
+import bz2
+import json
+import numpy as np
+
+
+def load_topomapping(filepath):
+    """Load a compressed topomapping file and return ``{label: [face ids]}``.
+
+    The file must be in the format shipped with ``rower`` (and ``constructive_geometries``), i.e. a bz2-compressed JSON object with the keys ``data`` (list of ``[label, [face ids]]``) and ``metadata``."""
+    with bz2.open(filepath, "rt") as f:
+        data = json.load(f)
+    return {label: faces for label, faces in data["data"]}
+
+
+def containment_from_topomapping(topomapping):
+    """Create a containment table from a location topomapping.
+
+    ``topomapping`` has the structure ``{location: [face ids]}``, and must define the regular locations (e.g. ``RER``, ``CA``, ``CA-QC``), not RoWs.
+
+    Returns ``{region: [leaf locations]}``. A leaf is a location which doesn't strictly contain any other location; when several locations have identical faces, the first in sorted order is the leaf. Regions are only included if their leaves cover *all* their faces, so that expanding a region never changes the area it describes. Leaf locations are not keys of the returned table."""
+    faces = {label: frozenset(v) for label, v in topomapping.items()}
+    labels = sorted(faces, key=lambda x: (len(faces[x]), x))
+
+    leaves = []
+    for label in labels:
+        if not any(faces[leaf] <= faces[label] for leaf in leaves):
+            leaves.append(label)
+
+    table = {}
+    for label in labels:
+        if label in leaves:
+            continue
+        contained = [leaf for leaf in leaves if faces[leaf] <= faces[label]]
+        if contained and frozenset().union(*(faces[leaf] for leaf in contained)) == faces[label]:
+            table[label] = sorted(contained)
+    return table
+
+
+def canonicalize(locations, containment):
+    """Expand ``locations`` into their leaf locations using the ``containment`` table.
+
+    Locations not in ``containment`` are kept as is. Returns a sorted tuple without duplicates, so equivalent sets of locations have the same canonical form."""
+    result = set()
+    for location in locations:
+        result.update(containment.get(location, [location]))
+    return tuple(sorted(result))
+
+
+def merge_similar(topomapping, areas, tolerance):
+    """Cluster labels whose areas differ by at most ``tolerance``.
+
+    ``topomapping`` is ``{label: [face ids]}``, e.g. the shipped RoW topomapping. ``areas`` is ``{face id: area}``. ``tolerance`` is the maximum area of the symmetric difference between two labels, as a fraction of the area of the larger one.
+
+    Labels are processed from largest to smallest area; each label not yet in a cluster starts a new one, and every remaining label within ``tolerance`` of it joins that cluster. The error of each label is therefore measured against the label it is merged into.
+
+    Returns ``({label: representative label}, {label: error as area fraction})``."""
+    labels = sorted(topomapping)
+    if not labels:
+        return {}, {}
+    faces = sorted({face for label in labels for face in topomapping[label]})
+    index = {face: i for i, face in enumerate(faces)}
+
+    # One row per label, one column per face
+    matrix = np.zeros((len(labels), len(faces)), dtype=bool)
+    for i, label in enumerate(labels):
+        matrix[i, [index[face] for face in topomapping[label]]] = True
+    face_areas = np.array([areas[face] for face in faces], dtype=float)
+
+    totals = matrix @ face_areas
+    intersection = (matrix * face_areas) @ matrix.T
+    larger = np.maximum(totals[:, None], totals[None, :])
+    larger[larger == 0] = 1
+    fraction = (totals[:, None] + totals[None, :] - 2 * intersection) / larger
+
+    mapping, errors = {}, {}
+    for i in sorted(range(len(labels)), key=lambda x: (-totals[x], labels[x])):
+        if labels[i] in mapping:
+            continue
+        for j in np.nonzero(fraction[i] <= tolerance)[0]:
+            if labels[j] not in mapping:
+                mapping[labels[j]] = labels[i]
+                errors[labels[j]] = float(fraction[i, j])
+    return mapping, errors
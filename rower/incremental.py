@@ -0,0 +1,227 @@
+from .base import Rower
+from .geography import canonicalize
+from bw2data.backends.peewee import ActivityDataset as AD
+from collections import defaultdict
+import json
+
+
+class IncrementalRower(Rower):
+    def __init__(self, database, profile_memory=False):
+        """``Rower`` which keeps RoW labels up to date after a database is edited, without redoing the whole database.
+
+        Run ``define_RoWs`` (or ``load_index``) once; afterwards, pass the codes of added, modified, or deleted activities to ``update``. Only the (name, product) keys of these activities are regrouped, and only the affected entries of ``self.labelled``, ``self.user_rows``, and the database locations are changed.
+
+        In addition to the ``Rower`` parameters, this class uses:
+
+        * ``self.groups``: ``{(name, product): [(location, code)]}`` for the keys with a RoW activity, with ``RoW`` as the location of RoW activities
+        * ``self.settings``: The ``prefix``, ``default_exclusions``, and ``containment`` used by ``define_RoWs``
+
+        Keys without a RoW activity are not stored, as changes to them can't change any RoW unless a RoW activity is added, which is then found in the database. For non-SQLite backends, ``update`` still has to iterate over the database to find the changed keys.
+
+        """
+        super(IncrementalRower, self).__init__(database, profile_memory=profile_memory)
+        self.groups = {}
+        self.settings = {"prefix": "RoW_user", "default_exclusions": True, "containment": None}
+        self._code_keys = {}
+        self._code_labels = {}
+        self._known = None
+        self._row_labels = None
+
+    def define_RoWs(self, prefix="RoW_user", default_exclusions=True, containment=None,
+                    partitions=None):
+        """Same as ``Rower.define_RoWs``, but also builds ``self.groups`` for later updates.
+
+        ``self.groups`` is filled while each partition is loaded, so ``partitions`` bounds the memory used by loading; the index itself holds all keys with a RoW activity. Activities already labelled with a RoW label known to this instance are treated as ``RoW`` activities."""
+        self.settings = {
+            "prefix": prefix,
+            "default_exclusions": default_exclusions,
+            "containment": containment,
+        }
+        self.groups = {}
+        self._row_labels = set(self.labelled).union(self.user_rows, self.existing)
+        try:
+            result = super(IncrementalRower, self).define_RoWs(
+                prefix=prefix,
+                default_exclusions=default_exclusions,
+                containment=containment,
+                partitions=partitions
+            )
+        finally:
+            self._row_labels = None
+        self._build_indices()
+        return result
+
+    def load_existing(self, dirname):
+        """Same as ``Rower.load_existing``; also rebuilds the indices used by ``update``."""
+        data = super(IncrementalRower, self).load_existing(dirname)
+        self._build_indices()
+        return data
+
+    def save_index(self, filepath):
+        """Save ``self.groups``, ``self.labelled``, ``self.user_rows``, ``self.existing``, and the grouping settings to a JSON file. Returns ``filepath``."""
+        data = {
+            "settings": self.settings,
+            "groups": [[name, product, lst] for (name, product), lst in self.groups.items()],
+            "labelled": self.labelled,
+            "user_rows": self.user_rows,
+            "existing": self.existing,
+        }
+        with open(filepath, "w", encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        return filepath
+
+    def load_index(self, filepath):
+        """Load an index created with ``save_index``. Replaces ``self.existing``."""
+        with open(filepath, encoding='utf-8') as f:
+            data = json.load(f)
+        self.settings = data["settings"]
+        self.groups = {(name, product): [tuple(x) for x in lst]
+                       for name, product, lst in data["groups"]}
+        self.labelled = data["labelled"]
+        self.user_rows = {k: tuple(v) for k, v in data["user_rows"].items()}
+        self.existing = data["existing"]
+        self._build_indices()
+
+    def update(self, codes):
+        """Regroup and relabel the RoWs affected by changes to activities ``codes`` (added, modified, or deleted).
+
+        Returns the number of locations changed."""
+        codes = set(codes)
+        if not codes:
+            return 0
+
+        # Keys before and after the changes
+        keys = {self._code_keys[code] for code in codes if code in self._code_keys}
+        keys.update(self._load_keys(codes))
+
+        row_labels = set(self.labelled).union(self.user_rows, self.existing)
+        data = self._normalize(self._load_groups_for_keys(keys), row_labels)
+
+        # Remove the RoW activities of affected keys from their current labels
+        stale = {code for key in keys for location, code in self.groups.get(key, [])
+                 if location == "RoW"}
+        stale.update(codes)
+        touched = set()
+        for code in stale:
+            label = self._code_labels.pop(code, None)
+            if label is not None:
+                self.labelled[label].remove(code)
+                touched.add(label)
+        for key in keys:
+            for _, code in self.groups.pop(key, []):
+                self._code_keys.pop(code, None)
+        for key, lst in data.items():
+            if any(location == "RoW" for location, _ in lst):
+                self.groups[key] = lst
+                self._code_keys.update((code, key) for _, code in lst)
+
+        grouped_data = self._reformat_rows(
+            data,
+            default_exclusions=self.settings["default_exclusions"],
+            containment=self.settings["containment"]
+        )
+        known = self._known_definitions()
+        mapping = {}
+        for excluded in sorted(grouped_data):
+            if excluded not in known:
+                known[excluded] = self._new_user_row(excluded)
+            label = known[excluded]
+            self.labelled.setdefault(label, []).extend(grouped_data[excluded])
+            self._code_labels.update(dict.fromkeys(grouped_data[excluded], label))
+            mapping.update(dict.fromkeys(grouped_data[excluded], label))
+
+        for label in touched:
+            if not self.labelled[label]:
+                del self.labelled[label]
+                if label in self.user_rows:
+                    excluded = self._canonical(self.user_rows.pop(label))
+                    if known.get(excluded) == label:
+                        del known[excluded]
+
+        changes = self._relabel(mapping)
+        self.journal.extend(changes)
+        return len(changes)
+
+    def _build_indices(self):
+        """Build the reverse indices ``{code: key}`` and ``{code: label}``"""
+        self._code_keys = {code: key for key, lst in self.groups.items() for _, code in lst}
+        self._code_labels = {code: label for label, lst in self.labelled.items()
+                             for code in lst}
+        self._known = None
+
+    def _known_definitions(self):
+        """Return ``{exclusion tuple: label}`` for user and existing RoWs, built once and then kept up to date"""
+        if self._known is None:
+            self._known = {}
+            for definitions in (self.user_rows, self.existing):
+                for label in sorted(definitions, reverse=True):
+                    self._known[self._canonical(definitions[label])] = label
+        return self._known
+
+    def _new_user_row(self, excluded):
+        """Add a new user RoW for ``excluded`` and return its label"""
+        prefix = self.settings["prefix"]
+        numbers = [int(label[len(prefix) + 1:]) for label in self.user_rows
+                   if label.startswith(prefix + "_") and label[len(prefix) + 1:].isdigit()]
+        label = "{}_{}".format(prefix, max(numbers) + 1 if numbers else 0)
+        self.user_rows[label] = excluded
+        return label
+
+    def _canonical(self, locations):
+        """Exclusion tuple of ``locations`` in the form returned by ``_reformat_rows``"""
+        if self.settings["containment"]:
+            return canonicalize(locations, self.settings["containment"])
+        return tuple(sorted(locations))
+
+    def _normalize(self, data, row_labels):
+        """Replace RoW labels (assigned by an earlier run) with ``RoW`` in ``{(name, product): [(location, code)]}``"""
+        return {key: [("RoW" if location in row_labels else location, code)
+                      for location, code in lst]
+                for key, lst in data.items()}
+
+    def _record_groups(self, data):
+        """Normalize loaded ``data`` and add the keys with a RoW activity to ``self.groups``"""
+        data = self._normalize(data, self._row_labels or set())
+        for key, lst in data.items():
+            if any(location == "RoW" for location, _ in lst):
+                self.groups[key] = lst
+        return data
+
+    def _load_groups_sqlite(self, shard=None, partitions=None):
+        data = super(IncrementalRower, self)._load_groups_sqlite(shard, partitions)
+        return self._record_groups(data)
+
+    def _load_groups_other_backend(self, shard=None, partitions=None):
+        data = super(IncrementalRower, self)._load_groups_other_backend(shard, partitions)
+        return self._record_groups(data)
+
+    def _load_keys(self, codes):
+        """Return set of current ``(name, product)`` keys for activity ``codes``"""
+        codes = sorted(codes)
+        if self.db.backend != 'sqlite':
+            codes = set(codes)
+            return {(obj['name'], obj.get('reference product'))
+                    for obj in self.db if obj['code'] in codes}
+        keys = set()
+        for i in range(0, len(codes), 500):
+            keys.update(AD.select(AD.name, AD.product).where(
+                AD.database == self.db.name, AD.code.in_(codes[i:i + 500])).tuples())
+        return keys
+
+    def _load_groups_for_keys(self, keys):
+        """Return dictionary of ``{(name, product): [(location, code)]`` for ``keys`` only"""
+        data = defaultdict(list)
+        if self.db.backend != 'sqlite':
+            for obj in self.db:
+                key = (obj['name'], obj.get('reference product'))
+                if key in keys:
+                    data[key].append((obj['location'], obj['code']))
+            return data
+        names = sorted({name for name, _ in keys})
+        for i in range(0, len(names), 500):
+            qs = AD.select(AD.name, AD.product, AD.location, AD.code).where(
+                AD.database == self.db.name, AD.name.in_(names[i:i + 500])).tuples()
+            for name, product, location, code in qs:
+                if (name, product) in keys:
+                    data[(name, product)].append((location, code))
+        return data
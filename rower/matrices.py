@@ -0,0 +1,105 @@
+from scipy import sparse
+import numpy as np
+
+
+# Geography ids below this are reserved for the shipped data packages
+USER_ID_OFFSET = 2 ** 20
+
+def exclusion_matrix(labelled, definitions):
+    """Build a sparse matrix of the locations excluded by each RoW activity.
+
+    ``labelled`` is ``{RoW label: [activity codes]}``, and ``definitions`` is ``{RoW label: [excluded locations]}``.
+
+    Returns ``(matrix, codes, locations)``, where ``matrix`` is a ``scipy.sparse.csr_matrix`` with one row per activity and one column per location, with a one where the activity's RoW excludes the location. ``codes`` and ``locations`` are sorted string arrays giving the activity code of each row and the location of each column."""
+    labels = sorted(labelled)
+    missing = [label for label in labels if label not in definitions]
+    if missing:
+        raise ValueError("No definitions for RoW labels: {}".format(missing))
+
+    codes = np.array(sorted(code for label in labels for code in labelled[label]), dtype=str)
+    locations = np.array(sorted({loc for label in labels for loc in definitions[label]}), dtype=str)
+
+    # Activities to RoW labels
+    code_labels = {code: i for i, label in enumerate(labels) for code in labelled[label]}
+    activities = sparse.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), [code_labels[code] for code in codes])),
+        shape=(len(codes), len(labels))
+    )
+    # RoW labels to excluded locations
+    rows, cols = [], []
+    for i, label in enumerate(labels):
+        indices = np.searchsorted(locations, sorted(set(definitions[label])))
+        rows.extend([i] * len(indices))
+        cols.extend(indices)
+    excluded = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape=(len(labels), len(locations))
+    )
+    return (activities @ excluded).tocsr(), codes, locations
+
+
+def save_exclusion_matrix(filepath, matrix, codes, locations):
+    """Save the results of ``exclusion_matrix`` to a ``.npz`` file."""
+    matrix = sparse.csr_matrix(matrix)
+    np.savez_compressed(
+        filepath,
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        shape=matrix.shape,
+        codes=codes,
+        locations=locations,
+    )
+
+
+def load_exclusion_matrix(filepath):
+    """Load a ``.npz`` file created with ``save_exclusion_matrix``. Returns ``(matrix, codes, locations)``."""
+    with np.load(filepath) as data:
+        matrix = sparse.csr_matrix(
+            (data["data"], data["indices"], data["indptr"]),
+            shape=tuple(data["shape"])
+        )
+        return matrix, data["codes"], data["locations"]
+
+
+def assign_geography_ids(geography_ids, labels, start=0, stop=None):
+    """Return a copy of ``geography_ids`` (``{label: integer id}``) with ids for all new ``labels``.
+
+    New ids are taken from the range ``[start, stop)``: existing ids are never changed, and new labels are sorted and get consecutive ids after the current maximum in this range (or from ``start``). Shipped data packages use ids below ``USER_ID_OFFSET``, and ids assigned by users are at or above it, so the two never collide. Raises ``ValueError`` if the range is full."""
+    result = dict(geography_ids)
+    in_range = [v for v in result.values() if v >= start and (stop is None or v < stop)]
+    first = max(in_range) + 1 if in_range else start
+    new = sorted(set(labels).difference(result))
+    if stop is not None and first + len(new) > stop:
+        raise ValueError("Not enough geography ids left below {}".format(stop))
+    result.update(zip(new, range(first, first + len(new))))
+    return result
+
+
+def geography_index(code_locations, geography_ids):
+    """Build a lookup index from activity codes to geography ids.
+
+    ``code_locations`` is an iterable of ``(activity code, location)``, and ``geography_ids`` is ``{label: integer id}``. Locations without an id get ``-1``.
+
+    Returns ``(codes, ids)``, a sorted string array and the matching ``int32`` array of geography ids."""
+    code_locations = sorted(code_locations)
+    codes = np.array([code for code, _ in code_locations], dtype=str)
+    ids = np.array([geography_ids.get(location, -1) for _, location in code_locations],
+                   dtype=np.int32)
+    return codes, ids
+
+
+def geography_id_array(codes, index):
+    """Look up the geography ids for an array of activity ``codes``.
+
+    ``index`` is the result of ``geography_index``. Returns an ``int32`` array; unknown codes get ``-1``."""
+    known_codes, known_ids = index
+    codes = np.asarray(codes, dtype=str)
+    result = np.full(codes.shape, -1, dtype=np.int32)
+    if not len(known_codes):
+        return result
+    positions = np.searchsorted(known_codes, codes)
+    positions[positions == len(known_codes)] = 0
+    found = known_codes[positions] == codes
+    result[found] = known_ids[positions[found]]
+    return result
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import tracemalloc
+
+
+class MemoryProfiler(object):
+    def __init__(self, top=10):
+        """Record memory allocated in each phase of a ``Rower`` run using ``tracemalloc``.
+
+        Tracing starts with the first phase and stays on between phases, so memory allocated in one phase and freed in a later one is subtracted from the later phase. Call ``stop`` when done to stop tracing. Phases can't be nested.
+
+        ``top`` is the number of source lines with the largest net allocations to keep for each phase.
+
+        See ``report`` for the recorded data."""
+        self.top = top
+        self.phases = []
+        self._started = False
+
+    def start(self):
+        """Start tracing memory allocations, if not already started."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    def stop(self):
+        """Stop tracing memory allocations, if started by this profiler."""
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager which records the memory allocated in phase ``name``.
+
+        Yields a dictionary, to which the caller can add counts of objects (e.g. number of activity codes)."""
+        self.start()
+        # Only available in Python 3.9+; otherwise the peak is an upper bound, see ``report``
+        exact_peak = hasattr(tracemalloc, "reset_peak")
+        if exact_peak:
+            tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start = tracemalloc.get_traced_memory()[0]
+        counts = {}
+        try:
+            yield counts
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            self.phases.append({
+                "phase": name,
+                "net": current - start,
+                "peak": peak - start,
+                "exact_peak": exact_peak,
+                "counts": counts,
+                "top": [
+                    {"location": str(stat.traceback), "size": stat.size_diff, "count": stat.count_diff}
+                    for stat in after.compare_to(before, "lineno")[:self.top]
+                ],
+            })
+            # Free the snapshots before the next phase starts
+            del before, after
+
+    def report(self):
+        """Return list of phases in the order they were run. Each phase is a dictionary with the keys:
+
+        * ``phase``: Name of the phase
+        * ``net``: Change in allocated bytes during the phase; negative if the phase freed memory allocated by an earlier phase
+        * ``peak``: Maximum bytes allocated during the phase, relative to the start of the phase
+        * ``exact_peak``: ``False`` before Python 3.9, where ``peak`` is an upper bound: the maximum since tracing started
+        * ``counts``: Dictionary of object counts for the main data structures
+        * ``top``: Source lines with the largest net allocations (``location``, ``size``, ``count``)
+
+        """
+        return self.phases
@@ -0,0 +1,194 @@
+"""Long-running local ``rower`` service, which keeps data packages and topomappings in memory between requests.
+
+Start the service with ``python -m rower.service [socket path] [default project]``, and send requests with ``RowerClient``. Requests and responses are JSON objects, one per line, over a Unix domain socket; nothing leaves the local machine."""
+from . import DATAPATH, USERPATH, RowerDatapackage
+from .base import Rower
+from .data_package import is_archive
+from .geography import load_topomapping
+from bw2data import projects
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+
+
+SOCKET_PATH = os.path.join(USERPATH, "rower.sock")
+
+
+class RowerService(object):
+    def __init__(self, project=None):
+        """Handle ``define``, ``label``, and ``validate`` requests, caching parsed data packages and topomappings.
+
+        Each request runs in the ``project`` given in the request, or else in the default ``project`` (the current ``bw2data`` project when the service is created). Projects must already exist.
+
+        Cached files are read again if they are changed on disk."""
+        self.project = project or projects.current
+        self.packages = {}
+        self.topomappings = {}
+
+    def handle(self, request):
+        """Handle one request dictionary and return the result."""
+        action = request.get("action")
+        if action == "ping":
+            return "pong"
+        if action not in ("define", "label", "validate"):
+            raise ValueError("Unknown action: {}".format(action))
+        project = request.get("project") or self.project
+        if project not in projects:
+            raise ValueError("Unknown project: {}".format(project))
+        if projects.current != project:
+            projects.set_current(project)
+        rower = Rower(request["database"])
+        return getattr(self, action)(rower, request)
+
+    def define(self, rower, request):
+        if request.get("existing"):
+            self._load_existing(rower, request["existing"])
+        rower.define_RoWs(
+            prefix=request.get("prefix", "RoW_user"),
+            default_exclusions=request.get("default_exclusions", True),
+            partitions=request.get("partitions"),
+        )
+        result = {}
+        if request.get("merge"):
+            merge = request["merge"]
+            result["merged"] = rower.merge_RoWs(
+                self.topomapping(merge["topomapping"]),
+                # JSON object keys are strings
+                {int(k): v for k, v in merge["areas"].items()},
+                merge.get("tolerance", 0.001)
+            )
+        result.update(labelled=rower.labelled, user_rows=rower.user_rows)
+        return result
+
+    def label(self, rower, request):
+        """Apply the activity mapping in ``package``, or define and label RoWs as in ``define``."""
+        if request.get("package"):
+            self._load_existing(rower, request["package"])
+            if not rower.labelled:
+                raise ValueError("No activity mapping found")
+            result = {}
+        else:
+            result = self.define(rower, request)
+        result["changed"] = rower.label_RoWs()
+        return result
+
+    def validate(self, rower, request):
+        self._load_existing(rower, request["package"])
+        return rower.validate_activity_map()
+
+    def package(self, dirname):
+        """Return the (cached) data of data package ``dirname``."""
+        path = self._resolve(dirname)
+        mtime = os.path.getmtime(path if is_archive(path) else
+                                 os.path.join(path, "datapackage.json"))
+        if path not in self.packages or self.packages[path][0] != mtime:
+            self.packages[path] = (mtime, RowerDatapackage(path).read_data())
+        return self.packages[path][1]
+
+    def topomapping(self, filepath):
+        """Return the (cached) decompressed topomapping in ``filepath``."""
+        mtime = os.path.getmtime(filepath)
+        if filepath not in self.topomappings or self.topomappings[filepath][0] != mtime:
+            self.topomappings[filepath] = (mtime, load_topomapping(filepath))
+        return self.topomappings[filepath][1]
+
+    def _load_existing(self, rower, dirname):
+        """Same as ``Rower.load_existing``, but using the cache. Copies, so cached data isn't changed."""
+        data = self.package(dirname)
+        if "Activity mapping" in data:
+            rower.labelled = {k: list(v) for k, v in data["Activity mapping"].items()}
+        if "Rest-of-World definitions" in data:
+            rower.existing = dict(data["Rest-of-World definitions"])
+        if "Geography ids" in data:
+            rower.geography_ids = dict(data["Geography ids"])
+
+    def _resolve(self, dirname):
+        for path in (dirname, os.path.join(DATAPATH, dirname), os.path.join(USERPATH, dirname)):
+            if is_archive(path) or os.path.isfile(os.path.join(path, "datapackage.json")):
+                return os.path.abspath(path)
+        raise OSError("Can't find data package {}".format(dirname))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"result": self.server.service.handle(json.loads(line.decode("utf-8")))}
+            except Exception as e:
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def make_server(path=SOCKET_PATH, project=None):
+    """Create a ``socketserver.UnixStreamServer`` for the ``rower`` service on socket ``path``, with default ``project`` (see ``RowerService``).
+
+    A stale socket left at ``path`` by a stopped service is removed. Raises ``OSError`` if ``path`` exists but isn't a socket, or if a service is already answering on it.
+
+    Requests are handled one at a time, as the current ``bw2data`` project is global state."""
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError("{} exists and isn't a socket".format(path))
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                raise OSError("A service is already running on {}".format(path))
+    server = socketserver.UnixStreamServer(path, _Handler)
+    server.service = RowerService(project)
+    return server
+
+
+def serve(path=SOCKET_PATH, project=None):
+    """Run the ``rower`` service on Unix domain socket ``path`` until interrupted."""
+    server = make_server(path, project)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+class RowerClient(object):
+    def __init__(self, path=SOCKET_PATH):
+        """Client for a ``rower`` service started with ``serve``."""
+        self.path = path
+
+    def request(self, action, **kwargs):
+        """Send one request and return its result. Raises ``RuntimeError`` if the service returns an error."""
+        kwargs["action"] = action
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            with sock.makefile("rwb") as f:
+                f.write(json.dumps(kwargs, ensure_ascii=False).encode("utf-8") + b"\n")
+                f.flush()
+                response = json.loads(f.readline().decode("utf-8"))
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def ping(self):
+        return self.request("ping")
+
+    def define(self, database, project=None, **kwargs):
+        """Define RoWs; returns ``{"labelled": ..., "user_rows": ...}``. See ``Rower.define_RoWs``.
+
+        Optional keyword arguments: ``existing``, ``prefix``, ``default_exclusions``, ``partitions``, and ``merge`` (``{"topomapping": filepath, "areas": {face id: area}, "tolerance": float}``)."""
+        return self.request("define", database=database, project=project, **kwargs)
+
+    def label(self, database, project=None, **kwargs):
+        """Label RoWs, using activity mapping ``package`` if given, otherwise as in ``define``. The result includes the number of ``changed`` locations."""
+        return self.request("label", database=database, project=project, **kwargs)
+
+    def validate(self, database, package, project=None):
+        """Validate the activity mapping in ``package``. See ``Rower.validate_activity_map``."""
+        return self.request("validate", database=database, package=package, project=project)
+
+
+if __name__ == "__main__":
+    serve(*sys.argv[1:3])
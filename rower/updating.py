@@ -1,4 +1,5 @@
 from . import DATAPATH, RowerDatapackage, Rower
+from .matrices import USER_ID_OFFSET, assign_geography_ids
 from bw2data import Database
 import os
 
@@ -9,7 +10,9 @@ def update_ecoinvent_definitions(new_ei):
     ``new_ei`` is a list of imported database names."""
 
     # Load existing data as a dictionary: "RoW_label": [list of locations]
-    existing = RowerDatapackage(Rower.EI_GENERIC).read_data()["Rest-of-World definitions"]
+    generic = RowerDatapackage(Rower.EI_GENERIC).read_data()
+    existing = generic["Rest-of-World definitions"]
+    geography_ids = generic["Geography ids"]
 
     for name in new_ei:
         print("Processing {}".format(name))
@@ -43,5 +46,11 @@ def update_ecoinvent_definitions(new_ei):
         dp = RowerDatapackage(os.path.join(DATAPATH, "ecoinvent " + name))
         dp.write_data("ecoinvent " + name, rows_used, labelled)
 
+    geography_ids = assign_geography_ids(
+        geography_ids,
+        set(existing).union(*existing.values()),
+        stop=USER_ID_OFFSET
+    )
+
     dp = RowerDatapackage(os.path.join(DATAPATH, "ecoinvent generic"))
-    dp.write_data("ecoinvent generic", existing)
+    dp.write_data("ecoinvent generic", existing, geography_ids=geography_ids)
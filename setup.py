@@ -9,7 +9,7 @@ setup(
     author_email="pascal.lesage@polymtl.com",
     license=open('LICENSE').read(),
     url="https://github.com/PascalLesage/rower",
-    install_requires=['bw2data', 'appdirs', 'pyprind'],
+    install_requires=['bw2data', 'appdirs', 'numpy', 'peewee', 'pyprind', 'scipy'],
     long_description=open('README.md').read(),
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -349,3 +349,520 @@ def test_custom_exclusions(basic, redirect_userdata):
         'RoW_user_1': ('IR', 'bar', 'foo'),
     }
     assert rwr.user_rows == expected
+
+def test_containment_from_topomapping():
+    from rower.geography import containment_from_topomapping
+    topo = {
+        'CA': [1, 2],
+        'CA-QC': [1],
+        'CA-ON': [2],
+        'Canada': [1, 2],
+        'RER': [3, 4, 5],
+        'DE': [3],
+    }
+    expected = {
+        'CA': ['CA-ON', 'CA-QC'],
+        'Canada': ['CA-ON', 'CA-QC'],
+    }
+    assert containment_from_topomapping(topo) == expected
+
+def test_canonicalize():
+    from rower.geography import canonicalize
+    containment = {'CA': ['CA-ON', 'CA-QC']}
+    assert canonicalize(['CA', 'DE'], containment) == ('CA-ON', 'CA-QC', 'DE')
+    assert canonicalize(['CA-QC', 'DE', 'CA-ON'], containment) == ('CA-ON', 'CA-QC', 'DE')
+
+@bw2test
+def test_define_RoWs_with_containment():
+    animal_data = {
+        ('animals', 'a'): {'name': 'a', 'reference product': 'a', 'exchanges': [],
+                           'unit': 'kilogram', 'location': 'CA'},
+        ('animals', 'a row'): {'name': 'a', 'reference product': 'a', 'exchanges': [],
+                               'unit': 'kilogram', 'location': 'RoW'},
+        ('animals', 'b on'): {'name': 'b', 'reference product': 'b', 'exchanges': [],
+                              'unit': 'kilogram', 'location': 'CA-ON'},
+        ('animals', 'b qc'): {'name': 'b', 'reference product': 'b', 'exchanges': [],
+                              'unit': 'kilogram', 'location': 'CA-QC'},
+        ('animals', 'b row'): {'name': 'b', 'reference product': 'b', 'exchanges': [],
+                               'unit': 'kilogram', 'location': 'RoW'},
+    }
+    Database('animals').write(animal_data)
+
+    rwr = rower.Rower('animals')
+    labelled, user_rows = rwr.define_RoWs(default_exclusions=False)
+    assert len(user_rows) == 2
+
+    labelled, user_rows = rwr.define_RoWs(
+        default_exclusions=False,
+        containment={'CA': ['CA-ON', 'CA-QC']}
+    )
+    assert user_rows == {'RoW_user_0': ('CA-ON', 'CA-QC')}
+    assert sorted(labelled['RoW_user_0']) == ['a row', 'b row']
+
+def test_merge_similar():
+    from rower.geography import merge_similar
+    topo = {
+        'RoW_0': [1, 2, 3],
+        'RoW_1': [1, 2, 3, 4],
+        'RoW_2': [1],
+    }
+    areas = {1: 50, 2: 30, 3: 19.5, 4: 0.5}
+    mapping, errors = merge_similar(topo, areas, 0.01)
+    assert mapping == {'RoW_0': 'RoW_1', 'RoW_1': 'RoW_1', 'RoW_2': 'RoW_2'}
+    assert errors['RoW_0'] == pytest.approx(0.005)
+    assert errors['RoW_1'] == 0
+
+    mapping, _ = merge_similar(topo, areas, 0)
+    assert mapping == {'RoW_0': 'RoW_0', 'RoW_1': 'RoW_1', 'RoW_2': 'RoW_2'}
+
+def test_merge_RoWs(basic):
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    topo = {'RoW_user_0': [1, 2], 'RoW_user_1': [1, 2, 3]}
+    areas = {1: 60, 2: 39.95, 3: 0.05}
+    report = rwr.merge_RoWs(topo, areas)
+    assert list(report) == ['RoW_user_0']
+    assert report['RoW_user_0'][0] == 'RoW_user_1'
+    assert list(rwr.user_rows) == ['RoW_user_1']
+    assert sorted(rwr.labelled['RoW_user_1']) == ['moggy', 'mutt', 'mutt pup']
+
+def test_exclusion_matrix(basic, tmpdir):
+    from rower.matrices import load_exclusion_matrix
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs(default_exclusions=False)
+    matrix, codes, locations = rwr.exclusion_matrix()
+    assert list(codes) == ['moggy', 'mutt', 'mutt pup']
+    assert list(locations) == ['CN', 'DE', 'IR']
+    assert matrix.toarray().tolist() == [[0, 0, 1], [1, 1, 0], [1, 1, 0]]
+
+    fp = rwr.save_exclusion_matrix(os.path.join(str(tmpdir), "matrix.npz"))
+    loaded, loaded_codes, loaded_locations = load_exclusion_matrix(fp)
+    assert (loaded != matrix).nnz == 0
+    assert list(loaded_codes) == list(codes)
+    assert list(loaded_locations) == list(locations)
+
+def test_assign_geography_ids():
+    from rower.matrices import assign_geography_ids
+    ids = assign_geography_ids({'RoW_0': 0, 'DE': 1}, ['FR', 'DE', 'CN'])
+    assert ids == {'RoW_0': 0, 'DE': 1, 'CN': 2, 'FR': 3}
+
+def test_builtin_geography_ids():
+    data = rower.RowerDatapackage(rower.Rower.EI_GENERIC).read_data()
+    ids = data["Geography ids"]
+    assert ids["RoW_0"] == 0
+    assert set(data["Rest-of-World definitions"]).issubset(ids)
+    assert len(set(ids.values())) == len(ids)
+
+def test_geography_id_array(basic, redirect_userdata):
+    import numpy as np
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    rwr.label_RoWs()
+    ids = rwr.assign_geography_ids()
+    assert ids['RoW_0'] == 0
+    array = rwr.geography_id_array(['mutt', 'moggy', 'pug', 'missing'])
+    assert array.dtype == np.int32
+    assert array.tolist() == [ids['RoW_user_0'], ids['RoW_user_1'], ids['CN'], -1]
+
+    rwr.save_data_package("foo", "bar")
+    other = rower.Rower("animals")
+    other.load_existing(os.path.join(str(rower.base.USERPATH), "foo"))
+    assert other.geography_ids == ids
+
+def test_define_RoWs_partitioned(basic):
+    rwr = rower.Rower("animals")
+    labelled, user_rows = rwr.define_RoWs()
+    expected = ({k: sorted(v) for k, v in labelled.items()}, user_rows)
+    for partitions in (1, 2, 5):
+        labelled, user_rows = rwr.define_RoWs(partitions=partitions)
+        assert ({k: sorted(v) for k, v in labelled.items()}, user_rows) == expected
+
+def test_shard_stable():
+    from rower.base import _shard
+    assert _shard('dogs', 'dog', 7) == _shard('dogs', 'dog', 7)
+    assert {_shard(str(i), None, 4) for i in range(100)} == {0, 1, 2, 3}
+
+def test_validate_activity_map(basic):
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    report = rwr.validate_activity_map()
+    assert report == {
+        'mapped': 3,
+        'duplicates': [],
+        'missing': [],
+        'not_row': [],
+        'unmapped': [],
+        'valid': True,
+    }
+    rwr.label_RoWs()
+    assert rwr.validate_activity_map()['valid']
+
+    rwr.labelled = {'RoW_user_0': ['mutt', 'pug', 'nope'], 'RoW_user_1': ['mutt']}
+    report = rwr.validate_activity_map()
+    assert report['duplicates'] == ['mutt']
+    assert report['missing'] == ['nope']
+    assert report['not_row'] == ['mutt', 'pug']
+    assert report['unmapped'] == []
+    assert not report['valid']
+
+def test_validate_activity_map_unmapped(basic):
+    rwr = rower.Rower("animals")
+    rwr.labelled = {'RoW_user_0': ['mutt']}
+    assert rwr.validate_activity_map()['unmapped'] == ['moggy', 'mutt pup']
+
+def test_search_index_updated(basic):
+    db = Database("animals")
+    db.make_searchable(reset=True)
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    rwr.label_RoWs()
+    assert db.metadata['searchable']
+    found = db.search("dogs", filter={"location": "row_user_0"})
+    assert sorted(obj['code'] for obj in found) == ['mutt', 'mutt pup']
+    assert len(db.search("dogs", filter={"location": "de"})) == 2
+    assert not db.search("dogs", filter={"location": "row"})
+
+def test_journal_and_rollback(basic, tmpdir):
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    assert rwr.label_RoWs() == 3
+    assert sorted(rwr.journal) == [
+        ('moggy', 'RoW', 'RoW_user_1'),
+        ('mutt', 'RoW', 'RoW_user_0'),
+        ('mutt pup', 'RoW', 'RoW_user_0'),
+    ]
+    assert rwr.label_RoWs() == 0
+
+    fp = rwr.save_journal(os.path.join(str(tmpdir), "journal.json"))
+    other = rower.Rower("animals")
+    other.load_journal(fp)
+    assert other.journal == rwr.journal
+
+    assert other.rollback() == 3
+    assert other.journal == []
+    assert get_activity(('animals', 'mutt'))['location'] == 'RoW'
+    assert get_activity(('animals', 'moggy'))['location'] == 'RoW'
+    assert get_activity(('animals', 'pug'))['location'] == 'CN'
+
+def test_unlabel_RoWs(basic, redirect_userdata):
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    rwr.label_RoWs()
+    dp = rwr.save_data_package("foo", "bar")
+
+    other = rower.Rower("animals")
+    assert other.unlabel_RoWs(dp) == 3
+    assert get_activity(('animals', 'mutt pup'))['location'] == 'RoW'
+    assert other.rollback() == 3
+    assert get_activity(('animals', 'mutt pup'))['location'] == 'RoW_user_0'
+
+    assert rwr.unlabel_RoWs() == 3
+    assert get_activity(('animals', 'moggy'))['location'] == 'RoW'
+
+    # Package names are resolved in the user data directory
+    assert rwr.label_RoWs() == 3
+    assert rwr.unlabel_RoWs("foo") == 3
+    with pytest.raises(OSError):
+        rwr.unlabel_RoWs("no such package")
+
+def test_incremental_update(basic, tmpdir):
+    rwr = rower.IncrementalRower("animals")
+    rwr.define_RoWs()
+    rwr.label_RoWs()
+    fp = rwr.save_index(os.path.join(str(tmpdir), "index.json"))
+
+    # Moving the persian cat to Germany changes the cat RoW only
+    act = get_activity(('animals', 'persian'))
+    act['location'] = 'DE'
+    act.save()
+    # A new RoW activity for an existing group
+    new = Database('animals').new_activity(
+        'pug row', name='dogs', location='RoW', unit='kilogram')
+    new['reference product'] = 'dog'
+    new.save()
+
+    other = rower.IncrementalRower("animals")
+    other.load_index(fp)
+    assert other.update(['persian', 'pug row']) == 2
+    assert get_activity(('animals', 'moggy'))['location'] == 'RoW_user_2'
+    assert get_activity(('animals', 'pug row'))['location'] == 'RoW_user_0'
+    assert get_activity(('animals', 'mutt'))['location'] == 'RoW_user_0'
+    assert other.user_rows['RoW_user_2'] == (
+        'AQ', 'AUS-AC', 'Bajo Nuevo', 'Clipperton Island', 'Coral Sea Islands', 'DE')
+    assert 'RoW_user_1' not in other.user_rows
+    assert 'RoW_user_1' not in other.labelled
+    assert sorted(other.labelled['RoW_user_0']) == ['mutt', 'mutt pup', 'pug row']
+
+    # Deleting an activity of a group; dogs now have the same RoW as cats
+    get_activity(('animals', 'pug')).delete()
+    assert other.update(['pug']) == 2
+    assert get_activity(('animals', 'mutt'))['location'] == 'RoW_user_2'
+    assert get_activity(('animals', 'mutt pup'))['location'] == 'RoW_user_0'
+    assert sorted(other.labelled['RoW_user_2']) == ['moggy', 'mutt', 'pug row']
+    assert other.labelled['RoW_user_0'] == ['mutt pup']
+
+def test_service(basic, redirect_userdata):
+    import tempfile
+    import threading
+    from rower.service import RowerClient, make_server
+
+    # The temporary test project database is in memory, so not shared with the service thread
+    projects.db.change_path(os.path.join(str(projects._base_data_dir), "projects.db"))
+    projects.set_current("default")
+
+    path = os.path.join(tempfile.mkdtemp(), "rower.sock")
+    server = make_server(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        client = RowerClient(path)
+        assert client.ping() == "pong"
+        result = client.define("animals", default_exclusions=False)
+        assert result["user_rows"] == {'RoW_user_0': ['CN', 'DE'], 'RoW_user_1': ['IR']}
+
+        rwr = rower.Rower("animals")
+        rwr.define_RoWs()
+        dirpath = rwr.save_data_package("foo", "bar")
+        assert client.validate("animals", "foo")["valid"]
+        assert dirpath in server.service.packages
+        assert client.label("animals", package="foo")["changed"] == 3
+        assert get_activity(('animals', 'mutt'))['location'] == 'RoW_user_0'
+        with pytest.raises(RuntimeError):
+            client.define("missing")
+
+        # Unknown projects are rejected, not created
+        with pytest.raises(RuntimeError):
+            client.define("animals", project="typo-project")
+        assert "typo-project" not in projects
+        # Requests without a project use the default project
+        default = projects.current
+        projects.create_project("other")
+        with pytest.raises(RuntimeError):
+            client.define("animals", project="other")
+        assert client.define("animals")["labelled"] == {}
+        assert projects.current == default
+
+        # A running service isn't replaced
+        with pytest.raises(OSError):
+            make_server(path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    # Stale sockets are removed, other files aren't
+    server = make_server(path)
+    server.server_close()
+    fp = os.path.join(os.path.dirname(path), "not a socket")
+    open(fp, "w").close()
+    with pytest.raises(OSError):
+        make_server(fp)
+    assert os.path.isfile(fp)
+
+def test_memory_profiling(basic):
+    rwr = rower.Rower("animals", profile_memory=True)
+    rwr.define_RoWs()
+    rwr.label_RoWs()
+    report = rwr.memory_profiler.report()
+    assert [x['phase'] for x in report] == ['load groups', 'group', 'label']
+    assert report[0]['counts'] == {'groups': 5, 'activities': 10}
+    assert report[1]['counts'] == {'exclusion_sets': 2, 'codes': 3}
+    assert report[2]['counts'] == {'labels': 2, 'codes': 3, 'changed': 3}
+    for phase in report:
+        assert phase['peak'] >= phase['net']
+        assert phase['peak'] > 0
+    rwr.memory_profiler.stop()
+
+def test_memory_profiler_frees_across_phases():
+    import tracemalloc
+    from rower.profiling import MemoryProfiler
+    profiler = MemoryProfiler()
+    with profiler.phase("allocate"):
+        data = [str(i) * 10 for i in range(10000)]
+    with profiler.phase("free"):
+        del data
+    assert tracemalloc.is_tracing()
+    profiler.stop()
+    assert not tracemalloc.is_tracing()
+    allocate, free = profiler.report()
+    assert allocate['net'] > 0
+    assert free['net'] < 0
+
+def test_memory_profiling_off(basic):
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    assert rwr.memory_profiler is None
+
+def test_archive_roundtrip(tmpdir):
+    fp = os.path.join(str(tmpdir), "cutoff.zip")
+    dp = rower.RowerDatapackage(rower.Rower.EI_3_5_CUTOFF)
+    assert dp.write_archive(fp) == fp
+    assert not os.path.isdir(fp)
+
+    archived = rower.RowerDatapackage(fp)
+    assert archived.archive
+    assert archived.metadata == dp.metadata
+    data = archived.read_data()
+    assert not data._cache
+    assert sorted(data) == sorted(dp.read_data())
+    assert data["Activity mapping"] == dp.read_data()["Activity mapping"]
+    assert list(data._cache) == ["Activity mapping"]
+    with pytest.raises(ValueError):
+        archived.write_data("foo", definitions={"RoW_0": ["DE"]})
+
+@bw2test
+def test_load_existing_from_archive(tmpdir):
+    Database('animals').write({
+        ('animals', "6ccf7e69afcf1b74de5b52ae28bbc1c2"): {
+            'name': 'dogs',
+            'reference product': 'dog',
+            'exchanges': [],
+            'unit': 'kilogram',
+            'location': 'RoW',
+        },
+    })
+    fp = rower.RowerDatapackage(rower.Rower.EI_3_4_CONSEQUENTIAL).write_archive(
+        os.path.join(str(tmpdir), "archive.zip"))
+    rwr = rower.Rower('animals')
+    rwr.apply_existing_activity_map(fp)
+    assert get_activity(('animals', "6ccf7e69afcf1b74de5b52ae28bbc1c2"))['location'] == "RoW_64"
+
+def test_missing_datapackage_not_created(basic, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    rwr = rower.Rower("animals")
+    with pytest.raises(OSError):
+        rwr.load_existing("no such package")
+    with pytest.raises(OSError):
+        rwr.apply_existing_activity_map("no such package")
+    assert not os.listdir(str(tmpdir))
+
+def test_geography_ids_shared_registry(basic, redirect_userdata):
+    Database('other').write({
+        ('other', 'a'): {'name': 'a', 'reference product': 'a', 'exchanges': [],
+                         'unit': 'kilogram', 'location': 'Narnia'},
+    })
+    first = rower.Rower("animals")
+    first.define_RoWs()
+    first.label_RoWs()
+    first_ids = dict(first.assign_geography_ids())
+
+    second = rower.Rower("other")
+    second_ids = second.assign_geography_ids()
+    assert second_ids['Narnia'] not in [first_ids[k] for k in first_ids]
+    assert all(second_ids[k] == v for k, v in first_ids.items())
+
+    third = rower.Rower("other")
+    third.geography_ids = {'Narnia': second_ids['Narnia'] + 1}
+    with pytest.raises(ValueError):
+        third.assign_geography_ids()
+
+def test_geography_ids_shipped_label_added(basic, redirect_userdata, tmpdir, monkeypatch):
+    import shutil
+    from rower.matrices import USER_ID_OFFSET
+    Database('other').write({
+        ('other', 'a'): {'name': 'a', 'reference product': 'a', 'exchanges': [],
+                         'unit': 'kilogram', 'location': 'Narnia'},
+    })
+    user_ids = rower.Rower("other").assign_geography_ids()
+    assert user_ids['Narnia'] == USER_ID_OFFSET
+
+    # New release of the generic package, with one more label
+    generic = os.path.join(str(tmpdir), "generic")
+    shutil.copytree(rower.Rower.EI_GENERIC, generic)
+    data = rower.RowerDatapackage(generic).read_data()
+    shipped = data["Geography ids"]
+    top = max(shipped.values())
+    shipped["RoW_new"] = top + 1
+    rower.RowerDatapackage(generic).write_data(
+        "ecoinvent generic", data["Rest-of-World definitions"], geography_ids=shipped)
+    monkeypatch.setattr(rower.Rower, 'EI_GENERIC', generic)
+
+    rwr = rower.Rower("other")
+    rwr.load_existing(generic)
+    ids = rwr.assign_geography_ids()
+    assert ids['RoW_new'] == top + 1
+    assert ids['Narnia'] == user_ids['Narnia']
+
+def test_geography_ids_old_registry_moved(basic, redirect_userdata):
+    from rower.matrices import USER_ID_OFFSET
+    shipped = rower.RowerDatapackage(rower.Rower.EI_GENERIC).read_data()["Geography ids"]
+    with open(os.path.join(str(rower.base.USERPATH), "geography_ids.json"), "w") as f:
+        json.dump({'Narnia': shipped['RoW_0'], 'Lilliput': USER_ID_OFFSET + 4}, f)
+    ids = rower.Rower("animals").assign_geography_ids()
+    assert ids['RoW_0'] == shipped['RoW_0']
+    assert ids['Lilliput'] == USER_ID_OFFSET + 4
+    assert ids['Narnia'] == USER_ID_OFFSET + 5
+    assert len(set(ids.values())) == len(ids)
+
+def test_geography_ids_concurrent(basic, redirect_userdata):
+    import threading
+    rwr = rower.Rower("animals")
+    threads = [threading.Thread(target=rwr._update_id_registry,
+                                args=({"place {} {}".format(i, j) for j in range(20)},))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(os.path.join(str(rower.base.USERPATH), "geography_ids.json")) as f:
+        ids = json.load(f)
+    assert all("place {} {}".format(i, j) in ids for i in range(8) for j in range(20))
+    assert len(set(ids.values())) == len(ids)
+
+def test_validate_activity_map_package_name(basic, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    rwr = rower.Rower("animals")
+    report = rwr.validate_activity_map("ecoinvent 3.5 cutoff")
+    assert report['missing']
+    assert report['unmapped'] == ['moggy', 'mutt', 'mutt pup']
+    with pytest.raises(OSError):
+        rwr.validate_activity_map("no such package")
+    assert not os.listdir(str(tmpdir))
+
+def test_search_index_writer_cancelled(basic, monkeypatch):
+    from bw2data.search import IndexManager
+    db = Database("animals")
+    db.make_searchable(reset=True)
+
+    def fail(self, ds):
+        raise ValueError
+    monkeypatch.setattr(IndexManager, '_format_dataset', fail)
+    rwr = rower.Rower("animals")
+    rwr.define_RoWs()
+    with pytest.raises(ValueError):
+        rwr.label_RoWs()
+    monkeypatch.undo()
+    assert db.metadata['searchable']
+    # Index isn't locked
+    rwr._update_search_index([get_activity(('animals', 'mutt'))._data])
+
+@bw2test
+def test_incremental_update_with_existing(tmpdir):
+    Database('animals').write({
+        ('animals', 'br'): {'name': 'dogs', 'reference product': 'dog', 'exchanges': [],
+                            'unit': 'kilogram', 'location': 'BR'},
+        ('animals', 'ch'): {'name': 'dogs', 'reference product': 'dog', 'exchanges': [],
+                            'unit': 'kilogram', 'location': 'CH'},
+        ('animals', 'arow'): {'name': 'dogs', 'reference product': 'dog', 'exchanges': [],
+                              'unit': 'kilogram', 'location': 'RoW'},
+    })
+    rwr = rower.IncrementalRower('animals')
+    rwr.load_existing(rwr.EI_GENERIC)
+    rwr.define_RoWs(partitions=3)
+    rwr.label_RoWs()
+    assert get_activity(('animals', 'arow'))['location'] == "RoW_88"
+    assert list(rwr.groups) == [('dogs', 'dog')]
+    fp = rwr.save_index(os.path.join(str(tmpdir), "index.json"))
+
+    new = Database('animals').new_activity(
+        'arow2', name='dogs', location='RoW', unit='kilogram')
+    new['reference product'] = 'dog'
+    new.save()
+
+    other = rower.IncrementalRower('animals')
+    other.load_index(fp)
+    assert other.update(['arow2']) == 1
+    assert get_activity(('animals', 'arow'))['location'] == "RoW_88"
+    assert get_activity(('animals', 'arow2'))['location'] == "RoW_88"
+    assert other.user_rows == {}
+    assert sorted(other.labelled['RoW_88']) == ['arow', 'arow2']